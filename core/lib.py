@@ -8,13 +8,19 @@
 #   python mindustry_img2mlog.py input.png --preset large      --upscale 4 --resample bicubic --colors 64 --out out --display display1
 #   + с wait:
 #   python mindustry_img2mlog.py input.png --wait 0.1 --wait-every 10
+#   + общая палитра для пачки спрайтов:
+#   python mindustry_img2mlog.py a.png b.png c.png --colors 48 --shared-palette --out out
+#   + спрайт-лист 32x32 (одинаковые ячейки конвертируются один раз):
+#   python mindustry_img2mlog.py sheet.png --atlas 32x32 --colors 32 --shared-palette --out out
 
 from __future__ import annotations
 
 import argparse
+import hashlib
+import json
 import os
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 import io
 from PIL import Image
 
@@ -66,22 +72,84 @@ def blend_over_bg(rgba: RGBA, bg: Tuple[int, int, int]) -> RGBA:
     nb = int(round(b * af + bg[2] * (1 - af)))
     return (nr, ng, nb, 255)
 
-def load_and_prepare(
-    path: str,
+def fit_to_blocks(
+    img: Image.Image,
     blocks_w: int,
     blocks_h: int,
     resample: Image.Resampling,
+) -> Image.Image:
+    img = img.convert("RGBA")
+    return img.resize((blocks_w, blocks_h), resample=resample)
+
+
+def sample_opaque_pixels(
+    img: Image.Image,
+    alpha_threshold: int,
+    max_samples: int,
+) -> bytes:
+    data = img.tobytes()
+    opaque = [i for i in range(0, len(data), 4) if data[i + 3] >= alpha_threshold]
+    step = max(1, -(-len(opaque) // max_samples)) if max_samples > 0 else 1
+    out = bytearray()
+    for i in opaque[::step]:
+        out += data[i:i + 3]
+    return bytes(out)
+
+
+def build_shared_palette(
+    images: Iterable[Image.Image],
+    colors: int,
+    alpha_threshold: int,
+    samples_per_image: int = 4096,
+) -> List[Tuple[int, int, int]]:
+    # images — уже уменьшенные fit_to_blocks; в памяти копятся только выборки пикселей.
+    samples = bytearray()
+    for img in images:
+        samples += sample_opaque_pixels(
+            img=img,
+            alpha_threshold=alpha_threshold,
+            max_samples=samples_per_image,
+        )
+
+    n = len(samples) // 3
+    if n == 0:
+        raise ValueError("Нет непрозрачных пикселей для построения палитры")
+
+    sample_img = Image.frombytes("RGB", (n, 1), bytes(samples))
+    q = sample_img.quantize(colors=colors, method=Image.Quantize.MEDIANCUT)
+    flat = q.getpalette()
+    used = sorted(i for _, i in q.getcolors())
+    return [(flat[3 * i], flat[3 * i + 1], flat[3 * i + 2]) for i in used]
+
+
+def build_palette_image(palette: List[Tuple[int, int, int]]) -> Image.Image:
+    # P-картинка 1x1 только ради палитры: ближайший цвет для каждого пикселя
+    # ищет Image.quantize(palette=...) в C, готовой таблицы заранее не строится.
+    if not palette or len(palette) > 256:
+        raise ValueError("Палитра должна содержать 1..256 цветов")
+
+    padded = list(palette) + [palette[0]] * (256 - len(palette))
+    pal_img = Image.new("P", (1, 1))
+    pal_img.putpalette([c for rgb in padded for c in rgb])
+    return pal_img
+
+
+def grid_from_image(
+    img: Image.Image,
     colors: Optional[int],
     bg: Tuple[int, int, int],
     alpha_threshold: int,
+    palette_img: Optional[Image.Image] = None,
 ) -> List[List[Optional[RGBA]]]:
-    img = Image.open(path).convert("RGBA")
-    img = img.resize((blocks_w, blocks_h), resample=resample)
-
-    if colors is not None:
+    # img — результат fit_to_blocks.
+    if palette_img is not None:
+        rgb = img.convert("RGB").quantize(palette=palette_img, dither=Image.Dither.NONE)
+        img = Image.merge("RGBA", (*rgb.convert("RGB").split(), img.getchannel("A")))
+    elif colors is not None:
         pal = img.convert("P", palette=Image.Palette.ADAPTIVE, colors=colors)
         img = pal.convert("RGBA")
 
+    blocks_w, blocks_h = img.size
     px = img.load()
     grid: List[List[Optional[RGBA]]] = []
     for y in range(blocks_h):
@@ -96,6 +164,98 @@ def load_and_prepare(
     return grid
 
 
+def prepare_image(
+    img: Image.Image,
+    blocks_w: int,
+    blocks_h: int,
+    resample: Image.Resampling,
+    colors: Optional[int],
+    bg: Tuple[int, int, int],
+    alpha_threshold: int,
+    palette_img: Optional[Image.Image] = None,
+) -> List[List[Optional[RGBA]]]:
+    return grid_from_image(
+        img=fit_to_blocks(img, blocks_w, blocks_h, resample),
+        colors=colors,
+        bg=bg,
+        alpha_threshold=alpha_threshold,
+        palette_img=palette_img,
+    )
+
+
+def load_and_prepare(
+    path: str,
+    blocks_w: int,
+    blocks_h: int,
+    resample: Image.Resampling,
+    colors: Optional[int],
+    bg: Tuple[int, int, int],
+    alpha_threshold: int,
+    palette_img: Optional[Image.Image] = None,
+) -> List[List[Optional[RGBA]]]:
+    return prepare_image(
+        img=Image.open(path),
+        blocks_w=blocks_w,
+        blocks_h=blocks_h,
+        resample=resample,
+        colors=colors,
+        bg=bg,
+        alpha_threshold=alpha_threshold,
+        palette_img=palette_img,
+    )
+
+
+def parse_cell_size(s: str) -> Tuple[int, int]:
+    parts = s.lower().split("x")
+    if len(parts) != 2:
+        raise argparse.ArgumentTypeError("Размер ячейки должен быть в формате WxH (например 32x32)")
+    try:
+        w, h = (int(p.strip()) for p in parts)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Размер ячейки должен быть в формате WxH (например 32x32)")
+    if w <= 0 or h <= 0:
+        raise argparse.ArgumentTypeError("Размер ячейки должен быть > 0")
+    return w, h
+
+
+def split_atlas(
+    sheet: Image.Image,
+    cell_w: int,
+    cell_h: int,
+) -> Tuple[List[Tuple[int, int, bytes]], Dict[bytes, Image.Image]]:
+    # Лист режется один раз: ячейки -> (col, row, хеш байтов), а картинка
+    # хранится только для первой из байт-в-байт одинаковых ячеек.
+    # Неполные ячейки у правого/нижнего края отбрасываются.
+    sheet = sheet.convert("RGBA")
+    cols = sheet.width // cell_w
+    rows = sheet.height // cell_h
+    cells: List[Tuple[int, int, bytes]] = []
+    unique: Dict[bytes, Image.Image] = {}
+    for row in range(rows):
+        for col in range(cols):
+            box = (col * cell_w, row * cell_h, (col + 1) * cell_w, (row + 1) * cell_h)
+            cell = sheet.crop(box)
+            raw = hashlib.blake2b(cell.tobytes(), digest_size=16).digest()
+            if raw not in unique:
+                unique[raw] = cell
+            cells.append((col, row, raw))
+    return cells, unique
+
+
+def grid_hash(grid: List[List[Optional[RGBA]]]) -> Optional[str]:
+    # None для полностью прозрачной ячейки: рисовать нечего.
+    h = hashlib.blake2b(digest_size=8)
+    empty = True
+    for row in grid:
+        for c in row:
+            if c is None:
+                h.update(b"\x00\x00\x00\x00")
+            else:
+                empty = False
+                h.update(bytes(c))
+    return None if empty else h.hexdigest()
+
+
 def greedy_merge_rects(grid: List[List[Optional[RGBA]]]) -> List[Rect]:
     h = len(grid)
     w = len(grid[0]) if h else 0
@@ -148,6 +308,40 @@ def rect_to_draw_commands(
     return x_px, y_px, w_px, h_px
 
 
+def rect_step_lines(
+    draw_ops_in_buf: int,
+    color_set: bool,
+    lines_since_wait: int,
+    drawbuf_limit: int,
+    wait_every: Optional[int],
+) -> Tuple[bool, int]:
+    # Сколько строк займёт один rect: [drawflush] [draw color] draw rect,
+    # вместе со вставленными wait (wait_every=None — без wait).
+    # drawflush ставится перед цветом, если цвет и rect не влезают в буфер вместе;
+    # последний буфер сбрасывает drawflush в конце программы.
+    need_flush = draw_ops_in_buf + (1 if color_set else 2) > drawbuf_limit
+    if need_flush:
+        color_set = False
+
+    lines = 0
+    steps = int(need_flush) + (0 if color_set else 1) + 1
+    for _ in range(steps):
+        lines += 1
+        if wait_every is not None:
+            lines_since_wait += 1
+            if lines_since_wait >= wait_every:
+                lines += 1
+                lines_since_wait = 0
+    return need_flush, lines
+
+
+def min_program_lines(drawbuf_limit: int, wait_time: Optional[float], wait_every: int) -> int:
+    # Заголовок (jump + end) + draw color + draw rect + drawflush + stop/end.
+    waits = wait_every if wait_time is not None and wait_time > 0 and wait_every > 0 else None
+    _, lines = rect_step_lines(0, False, 0, drawbuf_limit, waits)
+    return 2 + lines + 2
+
+
 def emit_programs(
     rects: List[Rect],
     target_w: int,
@@ -184,7 +378,7 @@ def emit_programs(
     def start_new_program():
         nonlocal cur_lines, is_first_program, draw_ops_in_buf, current_color, lines_since_wait
         cur_lines = []
-        cur_lines.append(f"jump 2 notEqual display1 null")
+        cur_lines.append(f"jump 2 notEqual {display_name} null")
         cur_lines.append(f"end")
         draw_ops_in_buf = 0
         current_color = None
@@ -243,43 +437,37 @@ def emit_programs(
                 cur_lines.append(f"wait {fmt_wait(wait_time)}")
                 lines_since_wait = 0
 
-    def flush_if_needed():
-        nonlocal draw_ops_in_buf, current_color
-        if draw_ops_in_buf >= drawbuf_limit:
-            add_line(f"drawflush {display_name}", count_for_wait=True)
-            draw_ops_in_buf = 0
-            current_color = None
-
     start_new_program()
 
     blocks_w = target_w // upscale
     blocks_h = target_h // upscale
     _ = blocks_w  
 
-    for color in colors_sorted:
-        rect_list = by_color[color]
-
-        ensure_space(2)
-
-        flush_if_needed()
+    waits = wait_every if wait_time is not None and wait_time > 0 and wait_every > 0 else None
 
-        if current_color != color:
-            r, g, b, a = color
-            add_line(f"draw color {r} {g} {b} {a} 0 0", count_for_wait=True)
-            draw_ops_in_buf += 1
-            current_color = color
-            flush_if_needed()
+    def plan_rect(color: RGBA) -> Tuple[bool, int]:
+        return rect_step_lines(
+            draw_ops_in_buf, current_color == color, lines_since_wait, drawbuf_limit, waits
+        )
 
-        for rect in rect_list:
-            ensure_space(2)
+    for color in colors_sorted:
+        for rect in by_color[color]:
+            # Все строки rect (с его draw color) резервируются разом,
+            # чтобы разрез программы не оторвал rect от цвета.
+            _, lines = plan_rect(color)
+            ensure_space(lines)
+            need_flush, _ = plan_rect(color)
+
+            if need_flush:
+                add_line(f"drawflush {display_name}", count_for_wait=True)
+                draw_ops_in_buf = 0
+                current_color = None
 
-            flush_if_needed()
             if current_color != color:
-                r, g, b, a = color      # Lib core generation.
+                r, g, b, a = color
                 add_line(f"draw color {r} {g} {b} {a} 0 0", count_for_wait=True)
                 draw_ops_in_buf += 1
                 current_color = color
-                flush_if_needed()
 
             x_px, y_px, w_px, h_px = rect_to_draw_commands(
                 rect=rect,
@@ -289,25 +477,113 @@ def emit_programs(
             )
             add_line(f"draw rect {x_px} {y_px} {w_px} {h_px} 0 0", count_for_wait=True)
             draw_ops_in_buf += 1
-            flush_if_needed()
 
     finalize_program()
     return ["\n".join(p) + "\n" for p in programs]
 
 
+def write_programs(programs: List[str], out_dir: str) -> None:
+    os.makedirs(out_dir, exist_ok=True)
+    for i, text in enumerate(programs, start=1):
+        fname = os.path.join(out_dir, f"prog_{i:02d}.mlog")
+        with open(fname, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+def batch_out_dirs(paths: List[str], out: str) -> List[str]:
+    if len(paths) == 1:
+        return [out]
+    # Имя папки выдаётся один раз: a.png, a.jpg и a_2.png не затрут друг друга.
+    dirs: List[str] = []
+    taken: set = set()
+    for path in paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        name = stem
+        n = 1
+        while name in taken:
+            n += 1
+            name = f"{stem}_{n}"
+        taken.add(name)
+        dirs.append(os.path.join(out, name))
+    return dirs
+
+
+def convert_atlas(
+    cells: List[Tuple[int, int, bytes]],
+    fitted: Dict[bytes, Image.Image],
+    cell_w: int,
+    cell_h: int,
+    out: str,
+    colors: Optional[int],
+    bg: Tuple[int, int, int],
+    alpha_threshold: int,
+    palette_img: Optional[Image.Image],
+    emit_kwargs: dict,
+) -> dict:
+    # fitted — уникальные ячейки из split_atlas, уже после fit_to_blocks.
+    by_raw: Dict[bytes, Optional[str]] = {}
+    tiles: Dict[str, dict] = {}
+
+    for raw, img in fitted.items():
+        grid = grid_from_image(
+            img=img,
+            colors=colors,
+            bg=bg,
+            alpha_threshold=alpha_threshold,
+            palette_img=palette_img,
+        )
+        key = grid_hash(grid)
+        by_raw[raw] = key
+
+        # Разные исходные ячейки могут дать одинаковую сетку после квантования.
+        if key is not None and key not in tiles:
+            programs = emit_programs(rects=greedy_merge_rects(grid), **emit_kwargs)
+            tile_dir = os.path.join("tiles", key)
+            write_programs(programs, os.path.join(out, tile_dir))
+            tiles[key] = {
+                "programs": [
+                    f"{tile_dir}/prog_{i:02d}.mlog" for i in range(1, len(programs) + 1)
+                ],
+                "cells": 0,
+            }
+
+    manifest_cells: List[dict] = []
+    for index, (col, row, raw) in enumerate(cells):
+        key = by_raw[raw]
+        if key is not None:
+            tiles[key]["cells"] += 1
+        manifest_cells.append({"index": index, "col": col, "row": row, "tile": key})
+
+    manifest = {
+        "cell_w": cell_w,
+        "cell_h": cell_h,
+        "cols": max(col for col, _, _ in cells) + 1,
+        "rows": max(row for _, row, _ in cells) + 1,
+        "tiles": tiles,
+        "cells": manifest_cells,
+    }
+    os.makedirs(out, exist_ok=True)
+    with open(os.path.join(out, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("image", help="Путь к картинке")
+    ap.add_argument("image", nargs="+", help="Путь к картинке (можно несколько)")
     ap.add_argument("--preset", choices=sorted(PRESETS.keys()), default="small-inner")
     ap.add_argument("--upscale", type=int, default=2, help="Размер блока (N): rect будет N×N (или шире при склейке)")
     ap.add_argument("--resample", choices=sorted(RESAMPLE_MAP.keys()), default="lanczos")
     ap.add_argument("--colors", type=int, default=None, help="Квантование до N цветов (например 32..96). Сильно экономит команды.")
+    ap.add_argument("--shared-palette", action="store_true", help="Одна общая палитра (--colors) для всех картинок: одинаковые цвета во всей пачке")
+    ap.add_argument("--palette-samples", type=int, default=4096, help="Сколько пикселей брать с каждой картинки для общей палитры")
+    ap.add_argument("--atlas", type=parse_cell_size, default=None, metavar="WxH", help="Спрайт-лист: резать на ячейки WxH пикселей, одинаковые ячейки конвертировать один раз (manifest.json)")
     ap.add_argument("--bg", type=parse_rgb, default=(0, 0, 0), help="Фон для clear и для смешивания альфы: r,g,b")
     ap.add_argument("--alpha-threshold", type=int, default=1, help="Пиксели с alpha < threshold пропускать (0..255)")
     ap.add_argument("--display", default="display1", help="Имя линка дисплея в процессоре (обычно display1)")
     ap.add_argument("--max-lines", type=int, default=1000, help="Лимит строк-инструкций на программу (обычно 1000)")
     ap.add_argument("--drawbuf-limit", type=int, default=240, help="Сколько draw-операций держать между drawflush (<=256)")
-    ap.add_argument("--out", default="out_mlog", help="Папка для результата")
+    ap.add_argument("--out", default="out_mlog", help="Папка для результата (для нескольких картинок — подпапка на каждую)")
     ap.add_argument("--use-end", action="store_true", help="Вместо stop поставить end (перерисовывать по кругу)")
 
     ap.add_argument("--wait", type=float, default=None, help="Вставлять 'wait T' после каждых N строк (T в секундах). Например 0.1")
@@ -320,25 +596,68 @@ def main():
     if target_w % args.upscale != 0 or target_h % args.upscale != 0:
         raise SystemExit("upscale должен делить размеры цели без остатка (например 80 при upscale=2/4/5 и т.п.)")
 
+    if args.drawbuf_limit < 2:
+        raise SystemExit("--drawbuf-limit должен быть >= 2 (draw color + draw rect в одном буфере)")
+
+    min_lines = min_program_lines(args.drawbuf_limit, args.wait, args.wait_every)
+    if args.max_lines < min_lines:
+        raise SystemExit(f"--max-lines должен быть >= {min_lines} (заголовок + draw color + draw rect + drawflush + stop, с учётом wait)")
+
+    if args.palette_samples < 1:
+        raise SystemExit("--palette-samples должен быть >= 1")
+
+    if args.shared_palette and args.colors is None:
+        raise SystemExit("--shared-palette требует --colors N")
+
+    if args.atlas is not None and len(args.image) != 1:
+        raise SystemExit("--atlas работает с одной картинкой (спрайт-листом)")
+
     blocks_w = target_w // args.upscale
     blocks_h = target_h // args.upscale
 
     resample = RESAMPLE_MAP[args.resample]
 
-    grid = load_and_prepare(
-        path=args.image,
-        blocks_w=blocks_w,
-        blocks_h=blocks_h,
-        resample=resample,
-        colors=args.colors,
-        bg=args.bg,
-        alpha_threshold=args.alpha_threshold,
-    )
-
-    rects = greedy_merge_rects(grid)
+    atlas_cells = None
+    atlas_fitted = None
+    if args.atlas is not None:
+        sheet = Image.open(args.image[0])
+        cut_w = sheet.width % args.atlas[0]
+        cut_h = sheet.height % args.atlas[1]
+        if cut_w or cut_h:
+            print(
+                f"Внимание: лист {sheet.width}x{sheet.height} не делится на ячейки "
+                f"{args.atlas[0]}x{args.atlas[1]}: отброшено {cut_w} px справа и {cut_h} px снизу"
+            )
+        atlas_cells, unique = split_atlas(sheet, *args.atlas)
+        if not atlas_cells:
+            raise SystemExit("Картинка меньше одной ячейки атласа")
+        atlas_fitted = {
+            raw: fit_to_blocks(cell, blocks_w, blocks_h, resample) for raw, cell in unique.items()
+        }
+        del unique
+
+    palette_img = None
+    if args.shared_palette:
+        if atlas_fitted is not None:
+            # Каждая уникальная ячейка — одна выборка, без учёта числа повторов.
+            images = atlas_fitted.values()
+        else:
+            # Картинки читаются по одной и сразу отпускаются; ниже каждая
+            # декодируется ещё раз, зато в памяти не копится вся пачка.
+            images = (fit_to_blocks(Image.open(path), blocks_w, blocks_h, resample) for path in args.image)
+        try:
+            palette = build_shared_palette(
+                images=images,
+                colors=args.colors,
+                alpha_threshold=args.alpha_threshold,
+                samples_per_image=args.palette_samples,
+            )
+        except ValueError as e:
+            raise SystemExit(str(e))
+        palette_img = build_palette_image(palette)
+        print(f"Общая палитра: {len(palette)} цвет(ов)")
 
-    programs = emit_programs(
-        rects=rects,
+    emit_kwargs = dict(
         target_w=target_w,
         target_h=target_h,
         margin=margin,
@@ -352,15 +671,46 @@ def main():
         wait_every=args.wait_every,
     )
 
-    os.makedirs(args.out, exist_ok=True)
-    for i, text in enumerate(programs, start=1):
-        fname = os.path.join(args.out, f"prog_{i:02d}.mlog")
-        with open(fname, "w", encoding="utf-8") as f:
-            f.write(text)
+    if args.atlas is not None:
+        manifest = convert_atlas(
+            cells=atlas_cells,
+            fitted=atlas_fitted,
+            cell_w=args.atlas[0],
+            cell_h=args.atlas[1],
+            out=args.out,
+            colors=args.colors,
+            bg=args.bg,
+            alpha_threshold=args.alpha_threshold,
+            palette_img=palette_img,
+            emit_kwargs=emit_kwargs,
+        )
+        print(
+            f"Готово: {len(manifest['cells'])} ячеек, уникальных тайлов: {len(manifest['tiles'])}, "
+            f"папка: {args.out} (manifest.json)"
+        )
+        return
+
+    for path, out_dir in zip(args.image, batch_out_dirs(args.image, args.out)):
+        grid = load_and_prepare(
+            path=path,
+            blocks_w=blocks_w,
+            blocks_h=blocks_h,
+            resample=resample,
+            colors=args.colors,
+            bg=args.bg,
+            alpha_threshold=args.alpha_threshold,
+            palette_img=palette_img,
+        )
+
+        rects = greedy_merge_rects(grid)
+
+        programs = emit_programs(rects=rects, **emit_kwargs)
+
+        write_programs(programs, out_dir)
 
-    print(f"Готово: {len(programs)} файл(а) в папке: {args.out}")
-    for i in range(1, len(programs) + 1):
-        print(f"  - prog_{i:02d}.mlog")
+        print(f"Готово: {len(programs)} файл(а) в папке: {out_dir}")
+        for i in range(1, len(programs) + 1):
+            print(f"  - prog_{i:02d}.mlog")
 
 
 if __name__ == "__main__":
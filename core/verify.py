@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+# mindustry_img2mlog VERIFY
+# Проверка эквивалентности движков lib: случайные сетки/пресеты/опции,
+# эталонный интерпретатор draw-подмножества mlog, лимиты --max-lines и --drawbuf-limit.
+#
+# Пример:
+#   python verify.py --cases 300 --seed 1
+#   + сравнить новый движок со старым:
+#   python verify.py --candidate-merge fastlib:greedy_merge_rects --candidate-emit fastlib:emit_programs
+#   + воспроизвести один упавший случай:
+#   python verify.py --seed 1234 --cases 1
+
+from __future__ import annotations
+
+import argparse
+import importlib
+import inspect
+import os
+import random
+import sys
+import tempfile
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+import lib
+from lib import PRESETS, RESAMPLE_MAP, RGBA, Rect
+
+Grid = List[List[Optional[RGBA]]]
+
+
+class VerifyError(Exception):
+    pass
+
+
+@dataclass
+class Case:
+    seed: int
+    preset: str
+    upscale: int
+    colors: Optional[int]
+    bg: Tuple[int, int, int]
+    alpha_threshold: int
+    resample: str
+    display_name: str
+    max_lines: int
+    drawbuf_limit: int
+    include_stop: bool
+    wait_time: Optional[float]
+    wait_every: int
+    shared_palette: bool
+
+    @property
+    def target(self) -> Tuple[int, int, int]:
+        return PRESETS[self.preset]
+
+    @property
+    def display(self) -> Tuple[int, int]:
+        # Картинка target_w x target_h с отступом margin с каждой стороны.
+        target_w, target_h, margin = self.target
+        return target_w + 2 * margin, target_h + 2 * margin
+
+    @property
+    def blocks(self) -> Tuple[int, int]:
+        target_w, target_h, _ = self.target
+        return target_w // self.upscale, target_h // self.upscale
+
+    def emit_kwargs(self) -> dict:
+        target_w, target_h, margin = self.target
+        return dict(
+            target_w=target_w,
+            target_h=target_h,
+            margin=margin,
+            upscale=self.upscale,
+            bg=self.bg,
+            display_name=self.display_name,
+            max_lines=self.max_lines,
+            drawbuf_limit=self.drawbuf_limit,
+            include_stop=self.include_stop,
+            wait_time=self.wait_time,
+            wait_every=self.wait_every,
+        )
+
+
+@dataclass
+class RunStats:
+    programs: int = 0
+    lines: int = 0
+    max_program_lines: int = 0
+    max_drawbuf: int = 0
+    draw_ops: int = 0
+
+
+@dataclass
+class Report:
+    checked: int = 0
+    failures: List[Tuple[int, str, str]] = field(default_factory=list)
+    totals: Dict[str, RunStats] = field(default_factory=dict)
+    worse: List[Tuple[int, RunStats, RunStats]] = field(default_factory=list)
+    skipped_palette: int = 0
+
+    def fail(self, case: Case, check: str, msg: str) -> None:
+        self.failures.append((case.seed, check, msg))
+
+    def add_stats(self, name: str, stats: RunStats) -> None:
+        t = self.totals.setdefault(name, RunStats())
+        t.programs += stats.programs
+        t.lines += stats.lines
+        t.max_program_lines = max(t.max_program_lines, stats.max_program_lines)
+        t.max_drawbuf = max(t.max_drawbuf, stats.max_drawbuf)
+        t.draw_ops += stats.draw_ops
+
+
+# ---------- генераторы ----------
+
+def random_case(seed: int) -> Case:
+    rng = random.Random(seed)
+    preset = rng.choice(sorted(PRESETS.keys()))
+    target_w, target_h, _ = PRESETS[preset]
+    upscales = [u for u in range(1, 12) if target_w % u == 0 and target_h % u == 0]
+    wait_time = rng.choice([None, None, 0.1, round(rng.uniform(0.001, 1.0), 3)])
+    wait_every = rng.choice([1, 3, 10, rng.randint(1, 50)])
+    drawbuf_limit = rng.choice([2, 3, 7, 64, 240, 256, rng.randint(2, 256)])
+    min_lines = lib.min_program_lines(drawbuf_limit, wait_time, wait_every)
+    return Case(
+        seed=seed,
+        preset=preset,
+        upscale=rng.choice(upscales),
+        colors=rng.choice([None, 2, 8, 16, 48, 96]),
+        bg=(rng.randrange(256), rng.randrange(256), rng.randrange(256)),
+        alpha_threshold=rng.choice([1, 1, 128, 255]),
+        resample=rng.choice(sorted(RESAMPLE_MAP.keys())),
+        display_name=rng.choice(["display1", "display2"]),
+        max_lines=rng.choice([min_lines, min_lines + 1, 16, 50, 1000, rng.randint(min_lines, 1000)]),
+        drawbuf_limit=drawbuf_limit,
+        include_stop=rng.random() < 0.5,
+        wait_time=wait_time,
+        wait_every=wait_every,
+        shared_palette=rng.random() < 0.5,
+    )
+
+
+def random_grid(rng: random.Random, w: int, h: int) -> Grid:
+    # Шум + заливка прямоугольниками: чтобы склейке было что склеивать.
+    n_colors = rng.choice([1, 2, 4, 16, 64])
+    palette: List[RGBA] = [
+        (rng.randrange(256), rng.randrange(256), rng.randrange(256), 255) for _ in range(n_colors)
+    ]
+    holes = rng.choice([0.0, 0.0, 0.1, 0.5, 1.0])
+
+    def pick() -> Optional[RGBA]:
+        return None if rng.random() < holes else rng.choice(palette)
+
+    grid: Grid = [[pick() for _ in range(w)] for _ in range(h)]
+    for _ in range(rng.randint(0, 12)):
+        x0, y0 = rng.randrange(w), rng.randrange(h)
+        x1, y1 = rng.randint(x0 + 1, w), rng.randint(y0 + 1, h)
+        c = pick()
+        for y in range(y0, y1):
+            for x in range(x0, x1):
+                grid[y][x] = c
+    return grid
+
+
+def random_image(rng: random.Random, w: int, h: int) -> Image.Image:
+    img = Image.new("RGBA", (w, h))
+    img.putdata([
+        (rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.choice([0, 40, 200, 255]))
+        for _ in range(w * h)
+    ])
+    return img
+
+
+# ---------- эталонные движки ----------
+
+def pixel_rects(grid: Grid) -> List[Rect]:
+    # Один rect на пиксель: медленно, но заведомо правильно.
+    return [
+        Rect(x=x, y=y, w=1, h=1, color=c)
+        for y, row in enumerate(grid)
+        for x, c in enumerate(row)
+        if c is not None
+    ]
+
+
+def accepts_palette(load: Callable) -> bool:
+    try:
+        params = inspect.signature(load).parameters.values()
+    except (TypeError, ValueError):
+        return True
+    return any(p.name == "palette_img" or p.kind is p.VAR_KEYWORD for p in params)
+
+
+def load_engine(spec: str) -> Callable:
+    module_name, _, func_name = spec.partition(":")
+    if not func_name:
+        raise argparse.ArgumentTypeError("Движок задаётся как module:function")
+    try:
+        return getattr(importlib.import_module(module_name), func_name)
+    except (ImportError, AttributeError) as e:
+        raise argparse.ArgumentTypeError(f"Не удалось загрузить движок {spec}: {e}")
+
+
+# ---------- интерпретатор mlog (draw-подмножество) ----------
+
+def run_mlog(
+    programs: List[str],
+    width: int,
+    height: int,
+    display_name: str,
+    max_lines: int,
+    drawbuf_limit: int,
+) -> Tuple[Grid, RunStats]:
+    # canvas[y][x], y=0 — нижняя строка дисплея (как в Mindustry).
+    canvas: Grid = [[None] * width for _ in range(height)]
+    stats = RunStats(programs=len(programs))
+
+    for n, text in enumerate(programs, start=1):
+        lines = text.splitlines()
+        where = f"prog_{n:02d}"
+        if len(lines) > max_lines:
+            raise VerifyError(f"{where}: {len(lines)} строк > --max-lines {max_lines}")
+        stats.lines += len(lines)
+        stats.max_program_lines = max(stats.max_program_lines, len(lines))
+
+        color: Optional[RGBA] = None
+        buf: List[Tuple] = []
+        pc = 0
+        steps = 0
+        while 0 <= pc < len(lines):
+            steps += 1
+            if steps > 10 * len(lines) + 10:
+                raise VerifyError(f"{where}: зацикливание")
+            op = lines[pc].split()
+            at = f"{where}:{pc}"
+            pc += 1
+            if not op:
+                continue
+            if op[0] == "jump":
+                # Подключён только линк display_name: проверка другого линка не пройдёт.
+                if len(op) == 3 and op[2] == "always":
+                    pc = int(op[1])
+                elif len(op) == 5 and op[2] == "notEqual" and op[4] == "null":
+                    if op[3] == display_name:
+                        pc = int(op[1])
+                else:
+                    raise VerifyError(f"{at}: неподдерживаемый jump: {lines[pc - 1]}")
+            elif op[0] in ("end", "stop"):
+                break
+            elif op[0] == "wait":
+                if len(op) != 2 or float(op[1]) < 0:
+                    raise VerifyError(f"{at}: плохой wait: {lines[pc - 1]}")
+            elif op[0] == "draw":
+                args = [int(a) for a in op[2:]]
+                if op[1] == "clear":
+                    buf.append(("clear", (args[0], args[1], args[2], 255)))
+                elif op[1] == "color":
+                    buf.append(("color", (args[0], args[1], args[2], args[3])))
+                    color = (args[0], args[1], args[2], args[3])
+                elif op[1] == "rect":
+                    if color is None:
+                        raise VerifyError(f"{at}: draw rect до draw color")
+                    x, y, w, h = args[:4]
+                    if w <= 0 or h <= 0 or x < 0 or y < 0 or x + w > width or y + h > height:
+                        raise VerifyError(f"{at}: rect {x} {y} {w} {h} вне дисплея {width}x{height}")
+                    buf.append(("rect", (x, y, w, h, color)))
+                else:
+                    raise VerifyError(f"{at}: неподдерживаемый draw {op[1]}")
+                stats.draw_ops += 1
+                stats.max_drawbuf = max(stats.max_drawbuf, len(buf))
+                if len(buf) > drawbuf_limit:
+                    raise VerifyError(f"{at}: {len(buf)} draw-операций без drawflush > --drawbuf-limit {drawbuf_limit}")
+            elif op[0] == "drawflush":
+                if len(op) != 2 or op[1] != display_name:
+                    raise VerifyError(f"{at}: drawflush не в {display_name}: {lines[pc - 1]}")
+                for kind, a in buf:
+                    if kind == "clear":
+                        canvas = [[a] * width for _ in range(height)]
+                    elif kind == "rect":
+                        x, y, w, h, c = a
+                        for yy in range(y, y + h):
+                            canvas[yy][x:x + w] = [c] * w
+                buf = []
+            else:
+                raise VerifyError(f"{at}: неизвестная инструкция: {lines[pc - 1]}")
+
+        if buf:
+            raise VerifyError(f"{where}: {len(buf)} draw-операций не сброшены drawflush")
+
+    return canvas, stats
+
+
+def expected_canvas(grid: Grid, case: Case) -> Grid:
+    _, _, margin = case.target
+    width, height = case.display
+    blocks_w, blocks_h = case.blocks
+    up = case.upscale
+    canvas: Grid = [[None] * width for _ in range(height)]
+    for by in range(blocks_h):
+        for bx in range(blocks_w):
+            c = grid[by][bx]
+            if c is None:
+                continue
+            y0 = margin + (blocks_h - 1 - by) * up
+            x0 = margin + bx * up
+            for yy in range(y0, y0 + up):
+                canvas[yy][x0:x0 + up] = [c] * up
+    return canvas
+
+
+def compare_canvas(got: Grid, want: Grid) -> Optional[str]:
+    bad = 0
+    first = None
+    for y, (rg, rw) in enumerate(zip(got, want)):
+        for x, (a, b) in enumerate(zip(rg, rw)):
+            if a != b:
+                bad += 1
+                if first is None:
+                    first = f"пиксель ({x},{y}): есть {a}, ожидалось {b}"
+    if bad:
+        return f"{bad} пикселей не совпадают, первый: {first}"
+    return None
+
+
+# ---------- проверки ----------
+
+def render_check(
+    report: Report,
+    case: Case,
+    name: str,
+    grid: Grid,
+    merge: Callable,
+    emit: Callable,
+) -> Optional[RunStats]:
+    width, height = case.display
+    try:
+        programs = emit(rects=merge(grid), **case.emit_kwargs())
+        canvas, stats = run_mlog(
+            programs,
+            width=width,
+            height=height,
+            display_name=case.display_name,
+            max_lines=case.max_lines,
+            drawbuf_limit=case.drawbuf_limit,
+        )
+    except VerifyError as e:
+        report.fail(case, name, str(e))
+        return None
+    except Exception as e:
+        report.fail(case, name, f"исключение {type(e).__name__}: {e}")
+        return None
+
+    report.add_stats(name, stats)
+    diff = compare_canvas(canvas, expected_canvas(grid, case))
+    if diff:
+        report.fail(case, name, diff)
+        return None
+    return stats
+
+
+def check_load(
+    report: Report,
+    case: Case,
+    engines: Dict[str, Callable],
+    tmpdir: str,
+    head_to_head: bool,
+) -> None:
+    rng = random.Random(case.seed ^ 0x5EED)
+    blocks_w, blocks_h = case.blocks
+    img = random_image(rng, rng.randint(1, 200), rng.randint(1, 200))
+    path = os.path.join(tmpdir, f"case_{case.seed}.png")
+    img.save(path)
+
+    # Независимо от lib: так картинку уменьшает сам Pillow.
+    resized = img.resize((blocks_w, blocks_h), resample=RESAMPLE_MAP[case.resample])
+
+    use_palette = (
+        case.shared_palette
+        and case.colors is not None
+        and resized.getextrema()[3][1] >= case.alpha_threshold
+    )
+    if use_palette and not accepts_palette(engines["load"]):
+        # Старый движок без palette_img: проверяется только на остальных случаях.
+        report.skipped_palette += 1
+        return
+
+    palette: Optional[List[Tuple[int, int, int]]] = None
+    kwargs = dict(
+        path=path,
+        blocks_w=blocks_w,
+        blocks_h=blocks_h,
+        resample=RESAMPLE_MAP[case.resample],
+        colors=case.colors,
+        bg=case.bg,
+        alpha_threshold=case.alpha_threshold,
+    )
+    try:
+        if use_palette:
+            palette = lib.build_shared_palette([resized], case.colors, case.alpha_threshold)
+            kwargs["palette_img"] = lib.build_palette_image(palette)
+        got = engines["load"](**kwargs)
+        want = lib.load_and_prepare(**kwargs) if head_to_head else got
+    except Exception as e:
+        report.fail(case, "load", f"исключение {type(e).__name__}: {e}")
+        return
+
+    if len(got) != blocks_h or any(len(row) != blocks_w for row in got):
+        report.fail(case, "load", f"размер сетки не {blocks_w}x{blocks_h}")
+        return
+    if got != want:
+        bad = sum(a != b for rg, rw in zip(got, want) for a, b in zip(rg, rw))
+        report.fail(case, "load", f"{bad} клеток отличаются от эталона")
+
+    # Альфа, по которой режется threshold и смешивается фон: после уменьшения,
+    # а при адаптивном квантовании — после него (Pillow квантует и альфу).
+    source = resized
+    if palette is None and case.colors is not None:
+        source = resized.convert("P", palette=Image.Palette.ADAPTIVE, colors=case.colors).convert("RGBA")
+    px = source.load()
+
+    blended: Dict[int, set] = {}
+    for y in range(blocks_h):
+        for x in range(blocks_w):
+            c = got[y][x]
+            r, g, b, a = px[x, y]
+            if a < case.alpha_threshold:
+                if c is not None:
+                    report.fail(case, "load", f"клетка ({x},{y}) с alpha {a} < threshold не пропущена")
+                    return
+                continue
+            if c is None:
+                report.fail(case, "load", f"клетка ({x},{y}) с alpha {a} >= threshold пропущена")
+                return
+            if palette is None:
+                ok = c == lib.blend_over_bg((r, g, b, a), case.bg)
+            else:
+                if a not in blended:
+                    blended[a] = {lib.blend_over_bg((*p, a), case.bg) for p in palette}
+                ok = c in blended[a]
+            if not ok:
+                report.fail(case, "load", f"клетка ({x},{y}) = {c}: не цвет палитры, смешанный с фоном по alpha {a}")
+                return
+
+    distinct = {c for row in got for c in row if c is not None}
+    if palette is not None:
+        # Альфа сохраняется попиксельно: цвет палитры смешивается с фоном для каждой альфы.
+        opaque = {got[y][x] for y in range(blocks_h) for x in range(blocks_w) if px[x, y][3] == 255}
+        if len(opaque) > len(palette):
+            report.fail(case, "load", f"{len(opaque)} непрозрачных цветов > палитры из {len(palette)}")
+    elif case.colors is not None and len(distinct) > case.colors:
+        report.fail(case, "load", f"{len(distinct)} разных цветов > --colors {case.colors}")
+
+    # Загруженная сетка должна так же точно рисоваться через mlog.
+    render_check(report, case, "load", got, engines["merge"], engines["emit"])
+
+
+def run_case(
+    report: Report,
+    case: Case,
+    engines: Dict[str, Callable],
+    tmpdir: str,
+    head_to_head: bool,
+) -> None:
+    rng = random.Random(case.seed)
+    blocks_w, blocks_h = case.blocks
+    grid = random_grid(rng, blocks_w, blocks_h)
+    report.checked += 1
+
+    # Сетка -> mlog -> интерпретатор должно дать ту же картинку.
+    render_check(report, case, "reference", grid, pixel_rects, lib.emit_programs)
+    old = render_check(report, case, "old", grid, lib.greedy_merge_rects, lib.emit_programs)
+    if head_to_head:
+        new = render_check(report, case, "new", grid, engines["merge"], engines["emit"])
+        # Новый движок не должен проигрывать старому ни на одном случае:
+        # больше программ, либо столько же программ, но больше строк.
+        if old is not None and new is not None and (new.programs, new.lines) > (old.programs, old.lines):
+            report.worse.append((case.seed, old, new))
+    check_load(report, case, engines, tmpdir, head_to_head)
+
+
+def print_report(report: Report, limit: int) -> None:
+    print(f"Случаев: {report.checked}, ошибок: {len(report.failures)}")
+    if report.skipped_palette:
+        print(f"  пропущено load-проверок с общей палитрой: {report.skipped_palette} (движок без palette_img)")
+    for name, t in report.totals.items():
+        print(
+            f"  {name:<9} программ: {t.programs:>6}  строк: {t.lines:>8}  draw-операций: {t.draw_ops:>8}  "
+            f"макс. строк/прог: {t.max_program_lines:>4}  макс. drawbuf: {t.max_drawbuf:>3}"
+        )
+    for seed, check, msg in report.failures[:limit]:
+        print(f"  FAIL seed={seed} [{check}] {msg}")
+    if len(report.failures) > limit:
+        print(f"  ... и ещё {len(report.failures) - limit}")
+    if report.worse:
+        print(f"Новый движок хуже старого в {len(report.worse)} случаях:")
+    for seed, old, new in report.worse[:limit]:
+        print(
+            f"  WORSE seed={seed} программ: {old.programs} -> {new.programs}  "
+            f"строк: {old.lines} -> {new.lines}"
+        )
+    if len(report.worse) > limit:
+        print(f"  ... и ещё {len(report.worse) - limit}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--cases", type=int, default=200, help="Сколько случайных случаев проверить")
+    ap.add_argument("--seed", type=int, default=0, help="Начальный seed (случай i использует seed+i)")
+    ap.add_argument("--candidate-load", type=load_engine, default=None, metavar="MODULE:FUNC", help="Новый load_and_prepare (без параметра palette_img случаи с общей палитрой пропускаются)")
+    ap.add_argument("--candidate-merge", type=load_engine, default=None, metavar="MODULE:FUNC", help="Новый greedy_merge_rects")
+    ap.add_argument("--candidate-emit", type=load_engine, default=None, metavar="MODULE:FUNC", help="Новый emit_programs")
+    ap.add_argument("--show", type=int, default=20, help="Сколько ошибок (и случаев, где новый движок хуже) печатать")
+
+    args = ap.parse_args()
+
+    engines = {
+        "load": args.candidate_load or lib.load_and_prepare,
+        "merge": args.candidate_merge or lib.greedy_merge_rects,
+        "emit": args.candidate_emit or lib.emit_programs,
+    }
+    head_to_head = any(
+        e is not None for e in (args.candidate_load, args.candidate_merge, args.candidate_emit)
+    )
+
+    report = Report()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for i in range(args.cases):
+            run_case(report, random_case(args.seed + i), engines, tmpdir, head_to_head)
+
+    print_report(report, args.show)
+    if report.failures or report.worse:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()